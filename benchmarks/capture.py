@@ -0,0 +1,50 @@
+"""
+Time how long piped input takes to be turned into a note body, without
+sending anything to Simplenote.
+
+    python benchmarks/capture.py [megabytes]
+"""
+
+import io
+import sys
+import time
+
+from simplenote_local import SimplenoteLocal
+
+
+def plain_text(megabytes):
+    line = '2024-01-01 12:00:00 INFO request served in 12ms from cache\n'
+    return line * (megabytes * 1024 * 1024 // len(line))
+
+
+def html(megabytes):
+    row = '<tr><td>cell</td><td><a href="/x">link</a></td></tr>\n'
+    rows = row * (megabytes * 1024 * 1024 // len(row))
+    return '<html><body><h1>Report</h1><table>%s</table></body></html>' % rows
+
+
+def measure(label, text, **kwargs):
+    start = time.perf_counter()
+    title, body, is_html = SimplenoteLocal.read_input(io.StringIO(text), **kwargs)
+    elapsed = time.perf_counter() - start
+    print('%-24s %8.2fs  %10d chars in  %10d chars out  html=%s' % (
+        label, elapsed, len(text), len(body), is_html,
+    ))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('HTML parser:', SimplenoteLocal.html_parser())
+
+    text = plain_text(megabytes)
+    measure('plain text', text)
+    measure('plain text, capped 1M', text, limit=1024 * 1024)
+
+    # HTML is converted to Markdown, so is far slower per megabyte
+    text = html(max(1, megabytes // 10))
+    measure('html', text)
+    measure('html, raw', text, raw=True)
+
+
+if __name__ == '__main__':
+    main()
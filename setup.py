@@ -17,4 +17,8 @@ setup(
         'toml',
         'watchdog',
     ],
+    extras_require={
+        # faster HTML parsing of piped input
+        'lxml': ['lxml'],
+    },
 )
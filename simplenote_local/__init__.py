@@ -1,18 +1,40 @@
 from bs4 import BeautifulSoup
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime
+import gzip
 import hashlib
-from markdownify import markdownify
+from itertools import repeat
+import json
+from markdownify import MarkdownConverter
 import nltk
 import os
 import pickle
 import re
+import shlex
 from simplenote import Simplenote
 import subprocess
 import sys
+import threading
 import time
 import toml
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from simplenote_local.grep import grep_file
+from simplenote_local.index import WordIndex
+from simplenote_local.revisions import RevisionStore
+
 from pprint import pprint
 
 
@@ -29,6 +51,7 @@ class Note:
         self.version = int(note.get('version', '0'))
         self.state = note.get('state', '')
         self.fingerprint = note.get('fingerprint', None)
+        self.synced = note.get('synced', True)
         self.title = note.get('title', '')
         self.body = note.get('body', '')
         content = note.get('content', None)
@@ -39,6 +62,7 @@ class Note:
         else:
             self.content = self.title + "\n\n" + self.body
         self.filename = note.get('filename', '%s.txt' % self.title)
+        self.previous_filename = ''
 
     @classmethod
     def title_and_body(cls, text):
@@ -120,6 +144,7 @@ class Note:
             'title': self.title,
             'filename': self.filename,
             'fingerprint': self.fingerprint,
+            'synced': self.synced,
             # state is internal flag, not useful to preserve
             # body stored in file
             # content can be derived from filename and body
@@ -127,28 +152,107 @@ class Note:
 
 
 class SimplenoteLocal:
-    def __init__(self, directory='.', user=False, password=False, editor='ed'):
+    # shared by every instance, so several accounts synced from one
+    # process load the stopwords once and do not interleave their output
+    stop_words = None
+    output_lock = threading.Lock()
+
+    def __init__(self, directory='.', user=False, password=False, editor='ed',
+                 workers=8, layout='flat', trash_retention=None,
+                 include_tags=None, exclude_tags=None, executor=None):
         self.directory = directory
+        self.include_tags = include_tags or []
+        self.exclude_tags = exclude_tags or []
         self.editor = editor
+        self.workers = workers
+        self.executor = executor
+        self.layout = layout
+        self.trash_retention = trash_retention
+        self.trash_store = None
+        self.trash_changed = False
+        self.lock = threading.RLock()
         self.user = user
         self.password = password
         self.simplenote_api = Simplenote(self.user, self.password)
-        self.notes, self.cursor, self.words = self.load_data()
+        (
+            self.notes,
+            self.cursor,
+            legacy_words,
+            self.directories,
+            previous_layout,
+            previous_scope,
+        ) = self.load_data()
         os.makedirs(self.directory, exist_ok=True)
+        self.journal = self.load_journal()
+        self.words = WordIndex(os.path.join(self.directory, 'notes.index'))
+        self.revisions = RevisionStore(os.path.join(self.directory, '.revisions'))
 
-        try:
-            self.stop_words = set(nltk.corpus.stopwords.words('english'))
-        except:
-            nltk.download('stopwords')
-            self.stop_words = set(nltk.corpus.stopwords.words('english'))
+        # older versions kept deleted notes along with the rest
+        for key in list(self.notes):
+            if self.notes[key].deleted:
+                self.store_note(self.notes[key])
+
+        if previous_layout != self.layout:
+            self.change_layout(previous_layout)
+
+        if previous_scope != self.scope:
+            # fetch everything again, to add and remove local files for
+            # notes now in or out of scope
+            self.cursor = ''
+
+        if SimplenoteLocal.stop_words is None:
+            try:
+                SimplenoteLocal.stop_words = set(nltk.corpus.stopwords.words('english'))
+            except:
+                nltk.download('stopwords')
+                SimplenoteLocal.stop_words = set(nltk.corpus.stopwords.words('english'))
+
+        if legacy_words and not len(self.words):
+            # older versions kept the words in notes.data
+            files = {}
+            for word in legacy_words:
+                for filename in legacy_words[word]:
+                    files.setdefault(filename, set()).add(word)
+            for filename in files:
+                self.words.add(filename, files[filename])
+        elif not os.path.exists(self.words.pathname):
+            # a missing index is rebuilt from the note files
+            for note in self.notes.values():
+                if note.synced:
+                    try:
+                        with open(self.note_pathname(note.filename), 'r') as handle:
+                            self.add_to_words_cache(note.filename, handle.read())
+                    except FileNotFoundError:
+                        pass
 
     def fetch_changes(self):
-        updates = self.get_note_updates()
+        # only applying the updates needs the lock, not fetching them
+        cursor, updates = self.get_note_updates()
+        with self.lock:
+            return self.apply_note_updates(cursor, updates)
+
+    def apply_note_updates(self, cursor, updates):
+        # returns how many updates were not already known, ie. were not
+        # just the result of sending local changes
+        writes = []
+        changed = 0
         for entry in updates:
+            self.revisions.record(entry)
             update = Note(entry)
             current = None
             if update.key in self.notes:
                 current = self.notes[update.key]
+            if current:
+                known_version = current.version
+            elif update.key in self.trash:
+                known_version = self.trash[update.key]['version']
+            else:
+                known_version = None
+            if known_version and update.version < known_version:
+                # fetched before a change was sent, so already out of date
+                continue
+            if known_version != update.version:
+                changed += 1
 
             if current and not current.deleted and current.title == update.title:
                 # continue using the established filename
@@ -166,91 +270,89 @@ class SimplenoteLocal:
                     else:
                         update.increment_filename()
 
-            if current and not current.deleted and current.filename != update.filename:
+            # notes outside of the tags being synced keep their metadata,
+            # but have no local file and are not indexed
+            has_file = current and current.synced
+            update.synced = self.in_scope(update) and not update.deleted
+
+            if has_file and update.synced and current.filename != update.filename:
                 os.rename(
-                    os.path.join(self.directory, current.filename),
-                    os.path.join(self.directory, update.filename),
+                    self.note_pathname(current.filename),
+                    self.note_pathname(update.filename, create=True),
                 )
                 print('  ', current.filename, '->', update.filename)
 
             if update.deleted:
-                if current and not current.deleted:
-                    self.remove_note_file(update)
+                if has_file:
+                    self.remove_note_file(current)
                 update.filename = ''
+                self.forget_operations(update.key)
+            elif not update.synced:
+                if has_file:
+                    self.remove_note_file(current)
             else:
                 self.add_to_words_cache(update.filename, update.content)
-                self.save_note_file(update)
-
-            self.notes[update.key] = update
+                # the stored fingerprint says whether the file needs
+                # rewriting, without having to read it first
+                if not has_file:
+                    self.report('++', update.filename)
+                    writes.append(update)
+                elif (update.version > current.version
+                        and current.fingerprint != update.fingerprint):
+                    self.report('<<', update.filename)
+                    writes.append(update)
+
+            self.store_note(update)
+
+        self.run_concurrently(self.write_note_file, writes)
+        # files must be on disk before the cursor saying they were
+        # fetched is, or a crash would lose the changes
+        self.sync_directories(writes)
+        self.cursor = cursor
         self.save_data()
+        return changed
 
     def send_changes(self):
-        for note in self.list_changed_notes():
-            new_note = self.send_one_change(note)
-            self.notes[note.key] = new_note
+        self.run_concurrently(self.send_one_change, self.list_changed_notes())
         self.save_data()
 
-    def watch_for_changes(self, fetch_interval, send_wait):
-        import threading
-        from watchdog.observers import Observer
-        from watchdog.events import FileSystemEventHandler
-
-        class Changes(FileSystemEventHandler):
-            def __init__(self, local):
-                super().__init__()
-                self.local = local
-                self.lock = threading.Lock()
-                self.found = self.local.list_changed_notes()
-
-            def on_any_event(self, event):
-                filename = os.path.basename(event.src_path)
-                if filename.endswith('.txt') and not filename.startswith('.'):
-                    with self.lock:
-                        self.found = self.local.list_changed_notes()
-
-        changes = Changes(self)
-        observer = Observer()
-        observer.schedule(changes, path=self.directory, recursive=True)
-        observer.start()
-
-        fetch_interval = timedelta(seconds=fetch_interval)
-        send_wait = timedelta(seconds=send_wait)
-        last_fetch = datetime.now() - fetch_interval
-
-        try:
-            while True:
-                time.sleep(1)
-
-                if datetime.now() - fetch_interval >= last_fetch:
-                    self.fetch_changes()
-                    last_fetch = datetime.now()
-
-                sent_change = False
-                with changes.lock:
-                    if changes.found:
-                        for note in changes.found:
-                            send = False
-                            filename = note.filename
-                            pathname = os.path.join(self.directory, filename)
-                            if os.path.exists(pathname):
-                                stamp = datetime.fromtimestamp(
-                                    os.path.getmtime(pathname)
-                                )
-                                if stamp + send_wait < datetime.now():
-                                    send = True
-                            else:
-                                send = True
-                            if send:
-                                new_note = self.send_one_change(note)
-                                self.notes[note.key] = new_note
-                                sent_change = True
-                        changes.found = self.list_changed_notes()
-                if sent_change:
-                    self.save_data()
-
-        except KeyboardInterrupt:
-            observer.stop()
-        observer.join()
+    def watch_for_changes(self, fetch_interval, send_wait, min_fetch_interval=None,
+                          metrics_file=None, metrics_port=None, prefetch_budget=0):
+        from simplenote_local.watch import Watcher
+        Watcher(
+            [self],
+            fetch_interval,
+            send_wait,
+            min_fetch_interval,
+            metrics_file,
+            metrics_port,
+            prefetch_budget,
+        ).run()
+
+    def send_file_changes(self, filenames):
+        notes = []
+        for filename in filenames:
+            if self.layout == 'sharded':
+                # new notes can be created at the top, not in their shard
+                pathname = os.path.join(self.directory, filename)
+                if os.path.exists(pathname):
+                    self.move_to_shard(filename, pathname)
+            known = self.get_note_by_filename(filename)
+            key = None
+            if known and known.filename == filename:
+                key = known.key
+            note = self.get_local_file_state(filename, key)
+            if note:
+                notes.append(note)
+
+        sent = 0
+        for note in self.detect_renames(notes):
+            if note.state == 'touched':
+                self.reconcile_touched_note(note)
+            elif note.state != 'unchanged':
+                self.send_one_change(note)
+                sent += 1
+        return sent
 
     def list_matching_notes(self, matches):
         for note in self.find_matching_notes(matches):
@@ -269,14 +371,45 @@ class SimplenoteLocal:
                 url = ' %s' % note.published_url
             print(f'"{filename}"{pinned}{shared}{tags}{url}')
 
+    def grep_notes(self, pattern, matches, context=0):
+        notes = self.find_matching_notes(matches)
+        pathnames = [
+            self.note_pathname(note.filename) for note in notes
+        ]
+
+        # starting worker processes is only worth it for a lot of files
+        executor = None
+        if len(pathnames) < 64:
+            results = map(grep_file, pathnames, repeat(pattern), repeat(context))
+        else:
+            executor = ProcessPoolExecutor()
+            results = executor.map(
+                grep_file,
+                pathnames,
+                repeat(pattern),
+                repeat(context),
+                chunksize = 16,
+            )
+
+        try:
+            for note, lines in zip(notes, results):
+                if not lines:
+                    continue
+                print('"%s"' % note.filename.replace('"', '\\"'))
+                previous = None
+                for number, line, matched in lines:
+                    if previous and number > previous + 1:
+                        print('    --')
+                    separator = ':' if matched else '-'
+                    print('%6d%s %s' % (number, separator, line))
+                    previous = number
+                print()
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
     def list_tags(self):
-        tags = dict()
-        for note in self.get_local_note_state():
-            for tag in note.tags:
-                if tag in tags:
-                    tags[tag] += 1
-                else:
-                    tags[tag] = 1
+        tags = self.count_tags(self.get_local_note_state())
         max_width = max(len(tag) for tag in tags)
         for tag in sorted(tags, key=lambda tag: tag.lower()):
             count = '  %d note' % tags[tag]
@@ -284,43 +417,55 @@ class SimplenoteLocal:
                 count = count + 's'
             print(tag.ljust(max_width), count)
 
+    def count_tags(self, notes):
+        tags = dict()
+        for note in notes:
+            for tag in note.tags:
+                if tag in tags:
+                    tags[tag] += 1
+                else:
+                    tags[tag] = 1
+        return tags
+
+    def answer_queries(self, stream):
+        # the local state is only read once, however many queries follow
+        notes = self.get_local_note_state()
+        for line in stream:
+            result = {'query': line.strip()}
+            try:
+                query = shlex.split(line)
+            except ValueError as error:
+                query = None
+                result['error'] = str(error)
+            if query == []:
+                continue
+            if query:
+                command, matches = query[0], query[1:]
+                if command == 'list':
+                    result['notes'] = [
+                        note.filename
+                            for note in self.find_matching_notes(matches, notes)
+                    ]
+                elif command == 'tags':
+                    result['tags'] = self.count_tags(notes)
+                elif command == 'info':
+                    result['notes'] = [
+                        self.note_metadata(note)
+                            for note in self.find_matching_notes(matches, notes)
+                    ]
+                else:
+                    result['error'] = 'unknown query "%s"' % command
+            print(json.dumps(result), flush=True)
+
     def add_tag(self, tag, matches):
-        matching = self.find_matching_notes(matches)
-        sent_change = False
-        for match in matching:
+        for match in self.find_matching_notes(matches):
             if tag not in match.tags:
-                match.tags.append(tag)
-
-                # touch the file even though the contents haven't changed
-                pathname = os.path.join(self.directory, match.filename)
-                now = int(datetime.now().timestamp())
-                os.utime(pathname, (now, now))
-                match.modified = now
-
-                new_note = self.send_one_change(match)
-                self.notes[match.key] = new_note
-                sent_change = True
-        if sent_change:
-            self.save_data()
+                self.record_operation(match, 'add_tag', tag)
 
     def remove_tag(self, tag, matches):
-        matching = self.find_matching_notes(matches)
-        sent_change = False
-        for match in matching:
+        for match in self.find_matching_notes(matches):
             if tag in match.tags:
-                match.tags.remove(tag)
-
-                # touch the file even though the contents haven't changed
-                pathname = os.path.join(self.directory, match.filename)
-                now = int(datetime.now().timestamp())
-                os.utime(pathname, (now, now))
-                match.modified = now
-
-                new_note = self.send_one_change(match)
-                self.notes[match.key] = new_note
-                sent_change = True
-        if sent_change:
-            self.save_data()
+                self.record_operation(match, 'remove_tag', tag)
 
     def edit_matching_notes(self, matches):
         matching = self.find_matching_notes(matches)
@@ -335,21 +480,33 @@ class SimplenoteLocal:
                     }))
 
         if matching:
+            # only the files opened in the editor can have been changed
+            # by it, so remember what they looked like beforehand
             command = [self.editor]
+            before = {}
             for note in matching:
-                pathname = os.path.join(self.directory, note.filename)
+                pathname = self.note_pathname(note.filename, create=True)
                 command.append(pathname)
+                before[note.filename] = self.file_snapshot(pathname)
 
             subprocess.run(command, check=True)
 
-            changes = False
-            for note in self.list_changed_notes():
-                for match in matching:
-                    if note.filename.lower() == match.filename.lower():
-                        new_note = self.send_one_change(note)
-                        self.notes[note.key] = new_note
-                        changes = True
-            if changes:
+            changed = []
+            for match in matching:
+                pathname = self.note_pathname(match.filename)
+                after = self.file_snapshot(pathname)
+                if after == before[match.filename] and match.state == 'unchanged':
+                    continue
+                note = self.get_local_file_state(match.filename, match.key)
+                if not note:
+                    continue
+                if note.state == 'touched':
+                    self.reconcile_touched_note(note)
+                elif note.state != 'unchanged':
+                    changed.append(note)
+
+            if changed:
+                self.run_concurrently(self.send_one_change, changed)
                 self.save_data()
         else:
             print("""** No notes found matching all of: %s.
@@ -367,26 +524,16 @@ Otherwise, this tool is looking for files with both the words "key" and
             )
             sys.exit(1)
 
-    def capture_stdin(self, raw, matches):
-        body = sys.stdin.read().replace('\r', '')
-        title = ''
-        now = int(datetime.now().timestamp())
+    def file_snapshot(self, pathname):
+        try:
+            stat = os.stat(pathname)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
-        # if the input looks like HTML, markdownify it and extract the first
-        # <h1> tag as the note title (which may not be the first line of text
-        # given global nav etc appearing first in source order)
-        soup = BeautifulSoup(body, 'html.parser')
-        first_header = soup.find('h1')
-        is_html = len(soup.find_all()) > 0
-        if first_header:
-            first_header = first_header.string
-        if is_html:
-            if not raw:
-                body = markdownify(body).lstrip().rstrip()
-                body = re.sub('\n\n\n*', '\n\n', body)
-            title, body = Note.title_and_body(body)
-            if first_header:
-                title = first_header
+    def capture_stdin(self, raw, matches, limit=None):
+        title, body, is_html = self.read_input(sys.stdin, raw, limit)
+        now = int(datetime.now().timestamp())
 
         if matches:
             matching = self.find_matching_notes(matches)
@@ -416,129 +563,436 @@ Otherwise, this tool is looking for files with both the words "key" and
                 'systemTags': system_tags,
             })
 
-        new_note = self.send_one_change(note)
-        self.notes[note.key] = new_note
+        self.send_one_change(note)
         self.save_data()
 
+    @classmethod
+    def read_input(cls, stream, raw=False, limit=None):
+        # only the start of the input is sniffed to decide if it is HTML,
+        # plain text is read in chunks and never goes near a parser
+        chunks = []
+        size = 0
+        is_html = None
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                break
+            chunk = chunk.replace('\r', '')
+            if is_html is None:
+                is_html = bool(re.search(r'<[a-zA-Z][^<>]*>', chunk))
+            if limit and size + len(chunk) > limit:
+                chunks.append(chunk[:limit - size])
+                print('** Input truncated to %d characters' % limit, file=sys.stderr)
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        body = ''.join(chunks)
+
+        if not is_html:
+            return '', body, False
+
+        # if the input looks like HTML, markdownify it and extract the first
+        # <h1> tag as the note title (which may not be the first line of text
+        # given global nav etc appearing first in source order)
+        soup = BeautifulSoup(body, cls.html_parser())
+        first_header = soup.find('h1')
+        if first_header:
+            first_header = first_header.string
+        if not raw:
+            body = MarkdownConverter().convert_soup(soup).lstrip().rstrip()
+            body = re.sub('\n\n\n*', '\n\n', body)
+        title, body = Note.title_and_body(body)
+        if first_header:
+            title = first_header
+        return title, body, True
+
+    @classmethod
+    def html_parser(cls):
+        try:
+            import lxml
+            return 'lxml'
+        except ImportError:
+            return 'html.parser'
+
+    def export_notes(self, pathname):
+        # one line of JSON per note, written as each note is read, so the
+        # notes are never all held in memory at once
+        output = sys.stdout.buffer if pathname == '-' else pathname
+        with self.lock:
+            notes = sorted(self.notes.values(), key=lambda note: note.created)
+
+        exported = 0
+        with gzip.open(output, 'wt', encoding='utf-8') as handle:
+            for note in notes:
+                content = self.exported_content(note)
+                if content is None:
+                    continue
+                handle.write(json.dumps({
+                    'key': note.key,
+                    'version': note.version,
+                    'content': content,
+                    'tags': note.tags,
+                    'systemTags': note.system_tags,
+                    'creationDate': note.created,
+                    'modificationDate': note.modified,
+                    'shareURL': note.share_url,
+                    'publishURL': note.publish_url,
+                }) + '\n')
+                exported += 1
+        print('%d notes exported.' % exported, file=sys.stderr)
+
+    def exported_content(self, note):
+        # the local file if there is one (including changes not yet sent),
+        # otherwise the version last seen
+        if note.synced:
+            try:
+                with open(self.note_pathname(note.filename), 'r') as handle:
+                    return note.filename[:-4] + "\n\n" + handle.read()
+            except FileNotFoundError:
+                pass
+        stored = self.revisions.get(note.key, note.version)
+        if stored:
+            return stored['content']
+
+        # last fetched before versions were stored locally
+        latest, error = self.simplenote_api.get_note(note.key)
+        if error:
+            print('** Not exported "%s": %s' % (note.title, latest), file=sys.stderr)
+            return None
+        self.revisions.record(latest)
+        return latest['content']
+
+    def import_notes(self, pathname, rate=10):
+        limiter = threading.Lock()
+        next_request = [time.monotonic()]
+        written = []
+        def import_note(note):
+            # no more than rate notes a second, however many workers
+            with limiter:
+                now = time.monotonic()
+                delay = next_request[0] - now
+                next_request[0] = max(next_request[0], now) + 1 / rate
+            if delay > 0:
+                time.sleep(delay)
+            new_note = self.import_note(note)
+            if new_note.synced:
+                written.append(new_note)
+
+        # notes are read as they are sent, with only a few waiting at
+        # once; filenames are settled as each is read, so notes sent at
+        # the same time cannot be given the same one
+        taken = set(note.filename.lower() for note in self.notes.values())
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.workers)
+        pending = set()
+        try:
+            for note in self.read_import(pathname):
+                self.unique_filename(note, taken)
+                if len(pending) >= self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(import_note, note))
+            for future in pending:
+                future.result()
+        finally:
+            # whatever was imported before any error is kept
+            wait(pending)
+            if not self.executor:
+                executor.shutdown()
+            self.sync_directories(written)
+            self.save_data()
+
+    def unique_filename(self, note, taken):
+        # give a note a filename not used by any other, nor by any in
+        # taken (lower cased), which it is then added to
+        while (note.filename.lower() in taken
+                or os.path.exists(self.note_pathname(note.filename))):
+            note.increment_filename()
+        taken.add(note.filename.lower())
+
+    def import_note(self, note):
+        filename = note.filename
+        new_note = self.send_note_update(note)
+        new_note.filename = filename
+        new_note.synced = self.in_scope(new_note)
+        if new_note.synced:
+            self.write_note_file(new_note)
+            self.add_to_words_cache(new_note.filename, new_note.content)
+        self.store_note(new_note)
+        self.report('++ note "%s" (%s)' % (filename, new_note.key))
+        return new_note
+
+    def read_import(self, pathname):
+        # notes from a directory of files, or from an export (which
+        # may or may not still be compressed)
+        if os.path.isdir(pathname):
+            for directory, subdirectories, filenames in os.walk(pathname):
+                subdirectories[:] = sorted(
+                    name for name in subdirectories if not name.startswith('.')
+                )
+                for filename in sorted(filenames):
+                    if filename.startswith('.') or not filename.endswith('.txt'):
+                        continue
+                    file_pathname = os.path.join(directory, filename)
+                    with open(file_pathname, 'r') as handle:
+                        body = handle.read()
+                    modified = int(os.path.getmtime(file_pathname))
+                    yield Note({
+                        'creationDate': modified,
+                        'modificationDate': modified,
+                        'content': filename[:-4] + "\n\n" + body,
+                        'state': 'new',
+                    })
+            return
+
+        with open(pathname, 'rb') as handle:
+            compressed = handle.read(2) == b'\x1f\x8b'
+        opener = gzip.open if compressed else open
+        now = int(datetime.now().timestamp())
+        with opener(pathname, 'rt', encoding='utf-8') as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if not entry.get('content', '').strip():
+                    continue
+                yield Note({
+                    'content': entry['content'],
+                    'tags': entry.get('tags', []),
+                    # published and shared are for Simplenote to decide
+                    'systemTags': [
+                        tag for tag in entry.get('systemTags', [])
+                            if tag in ('pinned', 'markdown')
+                    ],
+                    'creationDate': entry.get('creationDate', now),
+                    'modificationDate': entry.get('modificationDate', now),
+                    'state': 'new',
+                })
+
     def trash_notes(self, matches):
-        sent_change = False
+        # removing the file is enough to have it sent as a deletion
         for match in self.find_matching_notes(matches):
-            match.state = 'deleted'
             self.remove_note_file(match, 'quiet')
-            new_note = self.send_one_change(match)
-            self.notes[match.key] = new_note
-            sent_change = True
-
-        if sent_change:
-            self.save_data()
+            print('XX', match.filename, '(queued)')
 
     def restore_notes(self, matches):
-        sent_change = False
-        for key in self.notes:
-            note = self.notes[key]
-            if note.deleted:
-                for match in matches:
-                    if match.lower() in note.title.lower():
-                        latest, error = self.simplenote_api.get_note(note.key)
-                        if error:
-                            sys.exit(error)
-                        latest = Note(latest)
-                        latest.deleted = False
-                        latest.modified = datetime.now().timestamp()
-                        pathname = os.path.join(self.directory, latest.filename)
-                        with open(pathname, 'w') as handle:
-                            handle.write(latest.body)
-                        os.utime(pathname, (latest.modified, latest.modified))
-                        new_note = self.send_one_change(latest)
-                        self.notes[latest.key] = new_note
-                        sent_change = True
-
-        if sent_change:
+        keys = self.find_trashed_notes(matches)
+
+        # filenames are settled first, so notes restored at the same time
+        # (or a note still in use) cannot be given the same one
+        taken = set(note.filename.lower() for note in self.notes.values())
+        filenames = {}
+        for key in keys:
+            note = Note({'title': self.trash[key]['title']})
+            self.unique_filename(note, taken)
+            filenames[key] = note.filename
+
+        self.run_concurrently(
+            lambda key: self.restore_note(key, filenames[key]),
+            keys,
+            progress=True,
+        )
+        if keys:
             self.save_data()
 
+    def restore_note(self, key, filename=None):
+        latest, error = self.simplenote_api.get_note(key)
+        if error:
+            sys.exit(error)
+        self.revisions.record(latest)
+        latest = Note(latest)
+        if filename:
+            latest.filename = filename
+        latest.deleted = False
+        latest.modified = datetime.now().timestamp()
+        pathname = self.note_pathname(latest.filename, create=True)
+        with open(pathname, 'w') as handle:
+            handle.write(latest.body)
+        os.utime(pathname, (latest.modified, latest.modified))
+        return self.send_one_change(latest)
+
     def purge_notes(self, matches):
-        sent_change = False
-        deleted = []
-        for key in self.notes:
-            note = self.notes[key]
-            if note.deleted:
-                for match in matches:
-                    if match.lower() in note.title.lower():
-                        _, error = self.simplenote_api.delete_note(note.key)
-                        if error:
-                            sys.exit(error)
-                        sent_change = True
-                        print('XX', note.title)
-                        deleted.append(note.key)
-
-        if sent_change:
-            for key in deleted:
-                del self.notes[key]
+        keys = self.find_trashed_notes(matches)
+        self.run_concurrently(self.purge_note, keys, progress=True)
+        if keys:
+            for key in keys:
+                del self.trash[key]
+            self.trash_changed = True
             self.save_data()
 
+    def purge_note(self, key):
+        _, error = self.simplenote_api.delete_note(key)
+        if error:
+            sys.exit(error)
+        self.revisions.forget(key)
+        self.report('XX', self.trash[key]['title'])
+
+    def find_trashed_notes(self, matches):
+        # notes in the Trash matching any of the words, each only once
+        keys = set()
+        for key in self.trash:
+            title = self.trash[key]['title'].lower()
+            for match in matches:
+                if match.lower() in title:
+                    keys.add(key)
+        return sorted(keys, key=lambda key: self.trash[key]['title'].lower())
+
     def pin_notes(self, matches):
-        sent_change = False
         for match in self.find_matching_notes(matches):
-            match.system_tags.append('pinned')
-            new_note = self.send_one_change(match)
-            self.notes[match.key] = new_note
-            sent_change = True
-
-        if sent_change:
-            self.save_data()
+            if 'pinned' not in match.system_tags:
+                self.record_operation(match, 'pin')
 
     def unpin_notes(self, matches):
-        sent_change = False
         for match in self.find_matching_notes(matches):
-            match.system_tags.remove('pinned')
-            new_note = self.send_one_change(match)
-            self.notes[match.key] = new_note
-            sent_change = True
-
-        if sent_change:
+            if 'pinned' in match.system_tags:
+                self.record_operation(match, 'unpin')
+
+    def record_operation(self, note, operation, value=None):
+        # changes to notes' metadata are queued in a journal and sent
+        # later by --send or --watch, so do not need the network now
+        if not note.key:
+            # not sent yet, so nothing to queue the change against; it
+            # goes with the note itself instead
+            self.apply_operation(note, operation, value)
+            self.send_one_change(note)
             self.save_data()
+            return
+
+        entry = {
+            'key': note.key,
+            'operation': operation,
+            'value': value,
+            'time': int(datetime.now().timestamp()),
+        }
+        with self.journal_lock():
+            with open(os.path.join(self.directory, 'notes.journal'), 'a') as handle:
+                handle.write(json.dumps(entry) + '\n')
+                handle.flush()
+                os.fsync(handle.fileno())
+            self.journal.append(entry)
+        print('>>', note.filename, '(queued)')
+
+    def load_journal(self):
+        journal = []
+        try:
+            with open(os.path.join(self.directory, 'notes.journal'), 'r') as handle:
+                for line in handle:
+                    try:
+                        journal.append(json.loads(line))
+                    except ValueError:
+                        # partially written when interrupted, never recorded
+                        pass
+        except FileNotFoundError:
+            pass
+        return journal
+
+    def replay_journal(self, note):
+        # apply any queued operations to the local state of a note, which
+        # makes it a metadata change to be sent (repeated operations on
+        # the same note become a single update)
+        queued = False
+        for entry in self.journal:
+            if entry['key'] != note.key:
+                continue
+            self.apply_operation(note, entry['operation'], entry['value'])
+            note.modified = max(note.modified, entry['time'])
+            queued = True
+        if not queued:
+            return
+
+        if 'metadata' not in self.classify_change(note):
+            # already true of the note in Simplenote (such as a tag also
+            # added elsewhere, or added and removed again), so kept they
+            # would be replayed against whatever it later becomes
+            self.forget_operations(note.key)
+        elif note.state in ('unchanged', 'touched'):
+            note.state = 'changed'
+
+    def apply_operation(self, note, operation, value):
+        if operation == 'add_tag' and value not in note.tags:
+            note.tags.append(value)
+        elif operation == 'remove_tag' and value in note.tags:
+            note.tags.remove(value)
+        elif operation == 'pin' and 'pinned' not in note.system_tags:
+            note.system_tags.append('pinned')
+        elif operation == 'unpin' and 'pinned' in note.system_tags:
+            note.system_tags.remove('pinned')
+
+    def forget_operations(self, key):
+        if not any(entry['key'] == key for entry in self.journal):
+            return
+        with self.journal_lock():
+            # other processes may have added to the journal since it was
+            # loaded, which must not be lost
+            remaining = [
+                entry for entry in self.load_journal() if entry['key'] != key
+            ]
+            pathname = os.path.join(self.directory, 'notes.journal')
+            with open(pathname + '.tmp', 'w') as handle:
+                for entry in remaining:
+                    handle.write(json.dumps(entry) + '\n')
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(pathname + '.tmp', pathname)
+            self.journal = remaining
+
+    @contextmanager
+    def journal_lock(self):
+        # the journal is shared with other processes (such as --watch
+        # running while tags are added), so is only changed holding a lock
+        with self.lock:
+            pathname = os.path.join(self.directory, 'notes.journal.lock')
+            with open(pathname, 'a') as handle:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                yield
 
     def publish_notes(self, matches):
-        sent_change = False
-        for match in self.find_matching_notes(matches):
-            match.system_tags.append('published')
-            self.send_one_change(match)
-            key = match.key
-
-            # sending an update with the 'published' tag also causes a second
-            # change within Simplenote to generate and add the URL fragment,
-            # so give that a little time to happen (but not forever)
-            for _ in range(0, 10):
-                time.sleep(1)
-                self.fetch_changes()
-                note = self.notes[key]
-                if note.publish_url:
-                    break
+        matching = self.find_matching_notes(matches)
+        for match in matching:
+            if 'published' not in match.system_tags:
+                match.system_tags.append('published')
+        self.run_concurrently(self.send_one_change, matching)
+
+        # sending an update with the 'published' tag also causes a second
+        # change within Simplenote to generate and add the URL fragment,
+        # so give that a little time to happen (but not forever)
+        confirmed = self.confirm_remote_changes(
+            [match.key for match in matching],
+            lambda note: note.publish_url,
+        )
+        if matching:
+            self.save_data()
 
-            if note.publish_url:
-                print('   URL:', note.published_url)
+        failed = []
+        for match in matching:
+            note = confirmed[match.key]
+            if note:
+                print('   URL:', note.published_url, note.filename)
             else:
-                sys.exit('** Error publishing', note.filename)
+                failed.append(match.filename)
+        if failed:
+            sys.exit('** Error publishing %s' % ', '.join(failed))
 
     def unpublish_notes(self, matches):
-        sent_change = False
-        for match in self.find_matching_notes(matches):
-            match.system_tags.remove('published')
-            self.send_one_change(match)
-            key = match.key
-
-            # sending an update with the 'published' tag also causes a second
-            # change within Simplenote to generate and add the URL fragment,
-            # so give that a little time to happen (but not forever)
-            for _ in range(0, 10):
-                time.sleep(1)
-                self.fetch_changes()
-                note = self.notes[key]
-                if not note.publish_url:
-                    break
+        matching = self.find_matching_notes(matches)
+        for match in matching:
+            if 'published' in match.system_tags:
+                match.system_tags.remove('published')
+        self.run_concurrently(self.send_one_change, matching)
 
-            if note.publish_url:
-                sys.exit('** Error unpublishing', note.filename)
+        confirmed = self.confirm_remote_changes(
+            [match.key for match in matching],
+            lambda note: not note.publish_url,
+        )
+        if matching:
+            self.save_data()
+
+        failed = [
+            match.filename for match in matching if not confirmed[match.key]
+        ]
+        if failed:
+            sys.exit('** Error unpublishing %s' % ', '.join(failed))
 
     def show_note_info(self, matches):
         for match in self.find_matching_notes(matches):
@@ -559,6 +1013,18 @@ Otherwise, this tool is looking for files with both the words "key" and
         print('  version  ', note.version)
         print()
 
+    def note_metadata(self, note):
+        return {
+            'filename': note.filename,
+            'created': note.created,
+            'modified': note.modified,
+            'tags': [tag for tag in note.tags if tag not in note.share_list.split()],
+            'shared': note.share_list.split(),
+            'pinned': 'pinned' in note.system_tags,
+            'published': note.published_url,
+            'version': note.version,
+        }
+
     def show_note_history(self, matches, full=False):
         for match in self.find_matching_notes(matches):
             print(match.filename)
@@ -581,6 +1047,31 @@ Otherwise, this tool is looking for files with both the words "key" and
                     print('%06s...' % ('v%d' % version), end="\r")
             print('          ')
 
+    def prefetch_note_versions(self, budget, stop=None, recent=50, depth=10):
+        # fetch the versions --history would show of the most recently
+        # modified notes, that are not already stored locally; makes at
+        # most budget requests, returns how many were made
+        with self.lock:
+            notes = sorted(
+                (note for note in self.notes.values() if note.synced),
+                key=lambda note: note.modified,
+                reverse=True,
+            )[:recent]
+            wanted = [
+                (note.key, version)
+                    for note in notes
+                        for version in range(note.version, max(note.version - depth, 0), -1)
+            ]
+
+        requests = 0
+        for key, version in wanted:
+            if requests >= budget or (stop and stop.is_set()):
+                break
+            if not self.revisions.has(key, version):
+                self.get_note_version(key, version)
+                requests += 1
+        return requests
+
     def show_note_version(self, show):
         match = self.find_matching_notes([show[0],])[0]
         version = int(show[1])
@@ -611,26 +1102,27 @@ Every tenth version should be, so try version %d or %d.
         else:
             note.state = 'restored'
             note.version = None
-            new_note = self.send_one_change(note)
-            self.notes[note.key] = new_note
+            self.send_one_change(note)
             self.save_data()
 
     def list_changes(self):
-        for note in self.list_changed_notes():
-            key = note.key
-            if key:
-                updated = False
-                if note.modified != self.notes[key].modified:
-                    updated = True
-                if note.fingerprint != self.notes[key].fingerprint:
-                    updated = True
-                if updated:
-                    print('>>', note.filename)
-                else:
-                    print('XX', note.filename, end='\n\n')
-                    continue
-            else:
+        for note in self.get_local_note_state():
+            if note.state == 'unchanged':
+                continue
+            if note.state == 'deleted':
+                print('XX', note.filename, end='\n\n')
+                continue
+            if note.state == 'new':
                 print('++', note.filename)
+            elif note.state == 'renamed':
+                print('>>', note.previous_filename, '->', note.filename)
+                print('   changed:      renamed')
+            elif note.state == 'touched':
+                print('..', note.filename)
+                print('   changed:      timestamp only, will not be sent')
+            else:
+                print('>>', note.filename)
+                print('   changed:     ', ', '.join(self.classify_change(note)))
             print(
                 '   last updated:',
                 datetime.utcfromtimestamp(int(note.modified)),
@@ -638,27 +1130,26 @@ Every tenth version should be, so try version %d or %d.
             )
 
     def get_note_version(self, key, version):
-        cache_file = os.path.join(
-            '/tmp',
-            'simplenote_local.%s.%d.pickle' % (key, version)
-        )
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as handle:
-                note = pickle.load(handle)
-        else:
+        # versions already seen are served from the local store, only
+        # those never seen are asked for
+        note = self.revisions.get(key, version)
+        if note is None:
             note, error = self.simplenote_api.get_note(key, version)
             if error:
                 if str(note) != "HTTP Error 404: Not Found":
                     sys.exit(str(note))
+                self.revisions.record_missing(key, version)
                 note = None
-        with open(cache_file, 'wb') as handle:
-            pickle.dump(note, handle)
+            else:
+                self.revisions.record(note)
         if note:
             return Note(note)
         return None
 
-    def find_matching_notes(self, matches):
-        notes = set(self.get_local_note_state())
+    def find_matching_notes(self, matches, notes=None):
+        if notes is None:
+            notes = self.get_local_note_state()
+        notes = set(notes)
         for match in matches:
             matching = set()
             if match.startswith('#') or match.startswith('%'):
@@ -670,12 +1161,10 @@ Every tenth version should be, so try version %d or %d.
                     if match.lower() in note.filename.lower():
                         matching.add(note)
             else:
-                for word in self.words:
-                    if match in word:
-                        for note in notes:
-                            for filename in self.words[word]:
-                                if note.filename == filename:
-                                    matching.add(note)
+                filenames = self.words.search(match)
+                for note in notes:
+                    if note.filename in filenames:
+                        matching.add(note)
             notes = notes.intersection(matching)
 
         return sorted(
@@ -685,38 +1174,195 @@ Every tenth version should be, so try version %d or %d.
         )
 
     def list_changed_notes(self):
-        notes = self.get_local_note_state()
-        return list(filter(
-            lambda note: note.state != 'unchanged',
-            notes
-        ))
+        # what is sent must not miss files written into without their
+        # directory changing, so every shard is checked
+        changed = []
+        for note in self.get_local_note_state(full=True):
+            if note.state == 'touched':
+                self.reconcile_touched_note(note)
+            elif note.state != 'unchanged':
+                changed.append(note)
+        return changed
+
+    def classify_change(self, note):
+        # compare a note against the last state known from Simplenote,
+        # as not every difference needs sending
+        known = self.notes.get(note.key)
+        if not known:
+            return ['content']
+
+        changes = []
+        if note.fingerprint != known.fingerprint or note.filename != known.filename:
+            changes.append('content')
+        if (sorted(note.tags) != sorted(known.tags)
+                or sorted(note.system_tags) != sorted(known.system_tags)):
+            changes.append('metadata')
+        if not changes and note.modified != known.modified:
+            changes.append('timestamp')
+        return changes
+
+    def reconcile_touched_note(self, note):
+        # the file was touched, restored or checked out with identical
+        # content, so put the timestamp back rather than send it again
+        known = self.notes[note.key]
+        pathname = self.note_pathname(note.filename)
+        os.utime(pathname, (known.modified, known.modified))
+        note.modified = known.modified
+        note.state = 'unchanged'
 
     def send_one_change(self, note):
         if note.state == 'deleted':
             new_note = self.trash_note(note)
             new_note = Note(new_note)
-            print('XX', note.filename)
+            self.report('XX', note.filename)
         elif note.state == 'new':
+            if not self.in_scope(note) and self.include_tags:
+                # otherwise it would vanish locally on the next fetch
+                note.tags.append(self.include_tags[0])
             new_note = self.send_note_update(note)
-            pathname = os.path.join(self.directory, new_note.filename)
+            pathname = self.note_pathname(new_note.filename, create=True)
             with open(pathname, 'w') as handle:
                 handle.write(new_note.body)
             os.utime(pathname, (new_note.modified, new_note.modified))
-            print('++ note "%s" (%s)' % (note.filename, new_note.key))
+            self.report('++ note "%s" (%s)' % (note.filename, new_note.key))
         else:
+            if note.body is None:
+                # not read when the local state was checked
+                with open(self.note_pathname(note.filename), 'r') as handle:
+                    note.body = handle.read()
             note.content = note.filename[:-4] + "\n\n" + note.body
             new_note = self.send_note_update(note)
+            if note.state == 'renamed':
+                self.remove_file_from_words_cache(note.previous_filename)
             self.save_note_file(new_note)
-            print('>>', new_note.filename)
-        self.notes[new_note.key] = new_note
+            self.report('>>', new_note.filename)
+        self.store_note(new_note)
+        self.forget_operations(new_note.key)
         return new_note
 
+    def confirm_remote_changes(self, keys, confirmed, timeout=20):
+        # poll only the affected notes, backing off exponentially, until
+        # Simplenote reports the change as complete; returns the latest
+        # version of each note, or None if it never was confirmed
+        def poll(key):
+            delay = 0.5
+            waited = 0
+            while waited < timeout:
+                time.sleep(delay)
+                waited += delay
+                latest, error = self.simplenote_api.get_note(key)
+                if error:
+                    sys.exit(str(latest))
+                self.revisions.record(latest)
+                latest = Note(latest)
+                if confirmed(latest):
+                    return latest
+                delay = min(delay * 2, 5)
+            return None
+
+        results = dict(zip(keys, self.run_concurrently(poll, keys)))
+        for key in results:
+            note = results[key]
+            if note:
+                # the title is unchanged, keep the established filename
+                note.filename = self.notes[key].filename
+                self.store_note(note)
+        return results
+
+    def report(self, *args, **kwargs):
+        # output from notes being handled concurrently must not interleave
+        with self.output_lock:
+            print(*args, **kwargs)
+
+    def run_concurrently(self, function, items, progress=False):
+        items = list(items)
+        if len(items) < 2:
+            return [function(item) for item in items]
+
+        done = [0]
+        def run(item):
+            result = function(item)
+            if progress and sys.stderr.isatty():
+                with self.output_lock:
+                    done[0] += 1
+                    print('   %d/%d' % (done[0], len(items)), end='\r', file=sys.stderr)
+            return result
+
+        if self.executor:
+            # shared with other instances, to bound the threads in total
+            results = list(self.executor.map(run, items))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(run, items))
+        if progress and sys.stderr.isatty():
+            print(' ' * 12, end='\r', file=sys.stderr)
+        return results
+
+    def store_note(self, note):
+        # notes in the Trash are kept apart from the rest, and only as much
+        # as is needed to find, restore or purge them
+        if note.deleted:
+            self.notes.pop(note.key, None)
+            self.trash[note.key] = {
+                'title': note.title,
+                'version': note.version,
+                'deleted': note.modified or int(time.time()),
+            }
+            self.trash_changed = True
+        else:
+            # a note already known cannot also be in the Trash, so there
+            # is only any need to look when it is not
+            if note.key not in self.notes and note.key in self.trash:
+                del self.trash[note.key]
+                self.trash_changed = True
+            self.notes[note.key] = note
+
+    @property
+    def trash(self):
+        # only loaded by the commands that need it
+        if self.trash_store is None:
+            try:
+                with open(os.path.join(self.directory, 'notes.trash'), 'rb') as handle:
+                    self.trash_store = pickle.load(handle)
+            except FileNotFoundError:
+                self.trash_store = {}
+        return self.trash_store
+
+    def compact_trash(self):
+        if not self.trash_retention:
+            return
+        expires = time.time() - self.trash_retention * 86400
+        for key in list(self.trash):
+            if self.trash[key]['deleted'] < expires:
+                del self.trash[key]
+                self.trash_changed = True
+
     def get_note_updates(self):
         notes, error = self.simplenote_api.get_note_list(since=self.cursor)
         if error:
             sys.exit(error)
-        self.cursor = self.simplenote_api.current
-        return sorted(notes, key=lambda note: int(note['creationDate']))
+        return (
+            self.simplenote_api.current,
+            sorted(notes, key=lambda note: int(note['creationDate'])),
+        )
+
+    @property
+    def scope(self):
+        return {
+            'include': sorted(self.include_tags),
+            'exclude': sorted(self.exclude_tags),
+        }
+
+    def in_scope(self, note):
+        for tag in note.tags:
+            if tag in self.exclude_tags:
+                return False
+        if self.include_tags:
+            for tag in note.tags:
+                if tag in self.include_tags:
+                    return True
+            return False
+        return True
 
     def get_note_by_filename(self, filename):
         for key in self.notes:
@@ -744,70 +1390,222 @@ Every tenth version should be, so try version %d or %d.
         new_note, error = self.simplenote_api.update_note(update)
         if error:
             sys.exit('Error updating note "%s": %s.' % (note.filename, new_note))
+        self.revisions.record(new_note)
         return Note(new_note)
 
     def trash_note(self, note):
         new_note, error = self.simplenote_api.trash_note(note.key)
         if error:
             sys.exit('Error deleting "%s": %s.' % (note.filename, new_note))
+        self.revisions.record(new_note)
         return new_note
 
-    def get_local_note_state(self):
+    def get_local_note_state(self, full=False):
         expected_files = {}
         local_notes = []
 
         # compile a list of the notes already known
         for key in self.notes:
             note = self.notes[key]
-            if note.deleted:
+            if note.deleted or not note.synced:
                 continue
             expected_files[note.filename] = key
 
         # check known notes against the actual local notes
-        for filename in os.listdir(self.directory):
-            if filename.startswith('.'):
+        found, skipped = self.scan_note_files(full)
+        for filename in found:
+            local_notes.append(
+                self.get_local_file_state(filename, expected_files.pop(filename, None))
+            )
+
+        # deal with any known notes now removed, or in directories that
+        # have not changed since they were last checked
+        for filename in expected_files:
+            note = deepcopy(self.notes[expected_files[filename]])
+            if self.layout == 'sharded' and self.shard(filename) in skipped:
+                note.body = None
+                note.state = 'unchanged'
+                self.replay_journal(note)
+            else:
+                note.state = 'deleted'
+            local_notes.append(note)
+
+        local_notes = self.detect_renames(local_notes)
+
+        # directories containing changes have to be checked again next time
+        if self.layout == 'sharded':
+            for note in local_notes:
+                if note.state != 'unchanged':
+                    self.directories.pop(self.shard(note.filename), None)
+
+        return local_notes
+
+    def detect_renames(self, notes):
+        # a known note that has vanished and a new one with the same
+        # content appearing is a rename, better sent as an update to the
+        # existing note than as a deletion and a brand new note
+        vanished = {}
+        for note in notes:
+            if note.state == 'deleted':
+                vanished.setdefault(note.fingerprint, []).append(note)
+        if not vanished:
+            return notes
+
+        renamed = []
+        gone = set()
+        for note in notes:
+            if note.state == 'new' and vanished.get(note.fingerprint):
+                previous = vanished[note.fingerprint].pop()
+                rename = deepcopy(previous)
+                rename.previous_filename = previous.filename
+                rename.filename = note.filename
+                rename.body = note.body
+                # renaming does not change the file's modification time
+                rename.modified = int(time.time())
+                rename.state = 'renamed'
+                renamed.append(rename)
+                gone.add(id(note))
+                gone.add(id(previous))
+
+        return [note for note in notes if id(note) not in gone] + renamed
+
+    def scan_note_files(self, full=False):
+        # returns the filenames of all local notes, and the shards that
+        # were skipped as unchanged since the last time they were checked
+        # (unless full, when none are)
+        if self.layout != 'sharded':
+            found = [
+                filename for filename in os.listdir(self.directory)
+                    if filename.endswith('.txt') and not filename.startswith('.')
+            ]
+            return found, set()
+
+        found = {}
+        skipped = set()
+        directories = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
                 continue
-            if not filename.endswith('.txt'):
+            if entry.is_file():
+                if entry.name.endswith('.txt'):
+                    if self.move_to_shard(entry.name, entry.path):
+                        found[entry.name] = True
+                continue
+            if not entry.is_dir():
                 continue
 
-            pathname = os.path.join(self.directory, filename)
-            current = int(os.path.getmtime(pathname))
-            with open(pathname, 'r') as handle:
-                body = handle.read()
-                sha = hashlib.sha256(body.encode('utf-8')).hexdigest()
+            modified = entry.stat().st_mtime_ns
+            directories[entry.name] = modified
+            if not full and self.directories.get(entry.name) == modified:
+                skipped.add(entry.name)
+                continue
 
-            if filename in expected_files:
-                note = deepcopy(self.notes[expected_files[filename]])
-                note.body = body
-                note.state = 'unchanged'
-                if current != note.modified or sha != note.fingerprint:
-                    note.modified = current
-                    note.state = 'changed'
-                    self.add_to_words_cache(filename, body)
-                del expected_files[filename]
-                local_notes.append(note)
+            for filename in os.listdir(entry.path):
+                if filename.startswith('.') or not filename.endswith('.txt'):
+                    continue
+                if self.shard(filename) != entry.name:
+                    pathname = os.path.join(entry.path, filename)
+                    if not self.move_to_shard(filename, pathname):
+                        continue
+                found[filename] = True
+
+        self.directories = directories
+        return list(found), skipped
+
+    def shard(self, filename):
+        return hashlib.md5(filename.lower().encode('utf-8')).hexdigest()[0:2]
+
+    def note_pathname(self, filename, create=False):
+        if self.layout != 'sharded':
+            return os.path.join(self.directory, filename)
+        directory = os.path.join(self.directory, self.shard(filename))
+        if create:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def move_to_shard(self, filename, pathname):
+        # files created (or moved) into the wrong place are put in their shard
+        destination = self.note_pathname(filename, create=True)
+        if os.path.exists(destination):
+            print('** Not moving "%s", "%s" already exists.' % (
+                    pathname,
+                    destination,
+                ),
+                file=sys.stderr
+            )
+            return False
+        os.rename(pathname, destination)
+        return True
+
+    def change_layout(self, previous_layout):
+        for key in self.notes:
+            note = self.notes[key]
+            if note.deleted:
+                continue
+            if previous_layout == 'sharded':
+                source = os.path.join(
+                    self.directory, self.shard(note.filename), note.filename
+                )
             else:
-                note = Note({
-                    'creationDate': current,
-                    'modificationDate': current,
-                    'body': body,
-                    'content': filename[:-4] + "\n\n" + body,
-                    'filename': filename,
-                    'state': 'new',
-                })
-                self.add_to_words_cache(filename, body)
-                local_notes.append(note)
+                source = os.path.join(self.directory, note.filename)
+            if os.path.exists(source):
+                os.rename(source, self.note_pathname(note.filename, create=True))
+
+        if previous_layout == 'sharded':
+            for entry in os.scandir(self.directory):
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    try:
+                        os.rmdir(entry.path)
+                    except OSError:
+                        # not empty, so not only a shard
+                        pass
+
+        self.directories = {}
+        self.save_data()
 
-        # deal with any known notes now removed
-        for filename in expected_files:
-            note = deepcopy(self.notes[expected_files[filename]])
+    def get_local_file_state(self, filename, key=None):
+        pathname = self.note_pathname(filename)
+        if not os.path.exists(pathname):
+            if not key:
+                return None
+            note = deepcopy(self.notes[key])
             note.state = 'deleted'
-            local_notes.append(note)
-
-        return local_notes
+            return note
+
+        current = int(os.path.getmtime(pathname))
+        with open(pathname, 'r') as handle:
+            body = handle.read()
+            sha = hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+        if key:
+            note = deepcopy(self.notes[key])
+            note.body = body
+            note.state = 'unchanged'
+            if current != note.modified or sha != note.fingerprint:
+                note.modified = current
+                note.fingerprint = sha
+                if self.classify_change(note) == ['timestamp']:
+                    note.state = 'touched'
+                else:
+                    note.state = 'changed'
+                    self.add_to_words_cache(filename, body)
+            self.replay_journal(note)
+        else:
+            note = Note({
+                'creationDate': current,
+                'modificationDate': current,
+                'body': body,
+                'content': filename[:-4] + "\n\n" + body,
+                'filename': filename,
+                'state': 'new',
+            })
+            note.body = body
+            note.fingerprint = sha
+            self.add_to_words_cache(filename, body)
+        return note
 
     def save_note_file(self, note):
-        pathname = os.path.join(self.directory, note.filename)
+        pathname = self.note_pathname(note.filename, create=True)
 
         try:
             with open(pathname, 'r') as handle:
@@ -816,20 +1614,52 @@ Every tenth version should be, so try version %d or %d.
             current = None
 
         if note.body != current:
-            with open(pathname, 'w') as handle:
-                handle.write(note.body)
-            os.utime(pathname, (note.modified, note.modified))
+            self.write_note_file(note)
             if not current:
-                print('++', note.filename)
+                self.report('++', note.filename)
             else:
-                print('<<', note.filename)
+                self.report('<<', note.filename)
+        elif int(os.path.getmtime(pathname)) != note.modified:
+            # only the metadata changed, keep the timestamp in step
+            os.utime(pathname, (note.modified, note.modified))
+
+    def write_note_file(self, note):
+        # write alongside and then replace, so the file is never seen
+        # partially written; the leading dot means it is never taken for
+        # a note itself
+        pathname = self.note_pathname(note.filename, create=True)
+        temporary = os.path.join(
+            os.path.dirname(pathname),
+            '.%s.tmp' % note.filename,
+        )
+        with open(temporary, 'w') as handle:
+            handle.write(note.body)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.utime(temporary, (note.modified, note.modified))
+        os.replace(temporary, pathname)
+
+    def sync_directories(self, notes):
+        # files written by write_note_file are on disk, but their names
+        # are not until the directories holding them are too
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        directories = set(
+            os.path.dirname(self.note_pathname(note.filename)) for note in notes
+        )
+        for directory in directories:
+            descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
 
     def remove_note_file(self, note, quiet=False):
-        pathname = os.path.join(self.directory, note.filename)
+        pathname = self.note_pathname(note.filename)
         try:
             os.remove(pathname)
             if not quiet:
-                print('--', note.filename)
+                self.report('--', note.filename)
         except FileNotFoundError:
             # after deleting a file locally the next fetch will
             # include the state that the file has been removed,
@@ -838,28 +1668,16 @@ Every tenth version should be, so try version %d or %d.
         self.remove_file_from_words_cache(note.filename)
 
     def remove_file_from_words_cache(self, filename):
-        for word in self.words:
-            try:
-                self.words[word].remove(filename)
-            except KeyError:
-                pass
-            except ValueError:
-                pass
+        self.words.remove(filename)
 
     def add_to_words_cache(self, filename, content):
-        self.remove_file_from_words_cache(filename)
         words = set(
             word for word in [
                 re.sub(r'[\W_]+', '', word.lower())
                     for word in re.split(r'\b', filename[:-4] + content)
                 ] if word and len(word) < 30 and word not in self.stop_words
         )
-        for word in words:
-            if word not in self.words:
-                self.words[word] = [ filename, ]
-            else:
-                if filename not in self.words[word]:
-                    self.words[word].append(filename)
+        self.words.add(filename, words)
 
     def notes_as_dict(self):
         dict = {}
@@ -872,27 +1690,49 @@ Every tenth version should be, so try version %d or %d.
             with open(os.path.join(self.directory, 'notes.data'), 'rb') as handle:
                 data = pickle.load(handle)
         except FileNotFoundError:
-            data = {'notes': {}, 'cursor': '', 'words': {}}
+            data = {
+                'notes': {},
+                'cursor': '',
+                'layout': self.layout,
+                'scope': self.scope,
+            }
 
         # rehydrate the stored dicts as Note objects
         notes = {}
-        words = {}
         for key in data['notes']:
             notes[key] = Note(data['notes'][key])
 
-        return notes, data['cursor'], data['words']
+        return (
+            notes,
+            data['cursor'],
+            data.get('words', {}),
+            data.get('directories', {}),
+            data.get('layout', 'flat'),
+            data.get('scope', {'include': [], 'exclude': []}),
+        )
 
     def save_data(self):
+        if self.trash_store is not None:
+            self.compact_trash()
+        if self.trash_changed:
+            pathname = os.path.join(self.directory, 'notes.trash')
+            with open(pathname + '.tmp', 'wb') as handle:
+                pickle.dump(self.trash, handle)
+            os.replace(pathname + '.tmp', pathname)
+            self.trash_changed = False
+        self.words.save()
+
         with open(os.path.join(self.directory, 'notes.data'), 'wb') as handle:
             pickle.dump({
                 'notes': self.notes_as_dict(),
                 'cursor': self.cursor,
-                'words': self.words,
+                'directories': self.directories,
+                'layout': self.layout,
+                'scope': self.scope,
             }, handle)
         with open(os.path.join(self.directory, 'notes.toml'), 'w') as handle:
             toml.dump({
                 'notes': self.notes_as_dict(),
                 'cursor': self.cursor,
-                'words': self.words,
             }, handle)
 
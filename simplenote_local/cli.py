@@ -1,6 +1,8 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
+import toml
 from simplenote_local import SimplenoteLocal
 
 
@@ -21,24 +23,77 @@ def minimum_wait(value):
     return wait
 
 
-def main():
-    local = SimplenoteLocal(
-        directory = os.getenv(
+def size(value):
+    multiplier = 1
+    if value[-1:].upper() == 'K':
+        multiplier = 1024
+    elif value[-1:].upper() == 'M':
+        multiplier = 1024 * 1024
+    if multiplier > 1:
+        value = value[:-1]
+    return int(value) * multiplier
+
+
+def positive(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError('must be more than 0')
+    return number
+
+
+def tag_list(value):
+    return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+
+def load_profiles():
+    pathname = os.getenv(
+        'SIMPLENOTE_LOCAL_CONFIG',
+        os.path.expanduser('~/.config/simplenote-local.toml'),
+    )
+    try:
+        config = toml.load(pathname)
+    except FileNotFoundError:
+        return {}
+    return config.get('profiles', {})
+
+
+def make_local(profile={}, executor=None):
+    # settings in a profile override those from the environment
+    settings = {
+        'directory': os.getenv(
             'SIMPLENOTE_LOCAL_DIR',
             os.path.expanduser('~/notes')
         ),
-        user = os.getenv('SIMPLENOTE_LOCAL_USER'),
-        password = os.getenv('SIMPLENOTE_LOCAL_PASSWORD'),
-        editor = os.getenv(
+        'user': os.getenv('SIMPLENOTE_LOCAL_USER'),
+        'password': os.getenv('SIMPLENOTE_LOCAL_PASSWORD'),
+        'editor': os.getenv(
             'SIMPLENOTE_LOCAL_EDITOR',
                 os.getenv('VISUAL',
                     os.getenv('EDITOR', 'vi'),
         )),
-    )
+        'layout': os.getenv('SIMPLENOTE_LOCAL_LAYOUT', 'flat'),
+        'trash_retention': int(os.getenv('SIMPLENOTE_LOCAL_TRASH_RETENTION', '0')),
+        'include_tags': tag_list(os.getenv('SIMPLENOTE_LOCAL_INCLUDE_TAGS', '')),
+        'exclude_tags': tag_list(os.getenv('SIMPLENOTE_LOCAL_EXCLUDE_TAGS', '')),
+    }
+    settings.update(profile)
+    settings['directory'] = os.path.expanduser(settings['directory'])
+    for setting in ('include_tags', 'exclude_tags'):
+        if isinstance(settings[setting], str):
+            settings[setting] = tag_list(settings[setting])
+    return SimplenoteLocal(executor=executor, **settings)
+
 
+def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
+    parser.add_argument(
+        '--profile',
+        type = str,
+        default = os.getenv('SIMPLENOTE_LOCAL_PROFILE'),
+        help = 'Use the settings of PROFILE from the config file. With --watch and no profile, all profiles are watched.',
+    )
     parser.add_argument(
         '--fetch',
         action = 'store_true',
@@ -56,6 +111,30 @@ def main():
         action = 'store_true',
         help = 'List notes that contain any words in [matches ...]. Will list all notes if no list supplied.',
     )
+    notes.add_argument(
+        '--grep',
+        type = str,
+        metavar = 'TEXT',
+        help = 'Show lines in notes containing the exact TEXT (ignoring case), restricted to notes that match [matches ...].',
+    )
+    notes.add_argument(
+        '--batch',
+        action = 'store_true',
+        help = 'Answer queries read one per line from stdin ("list [matches ...]", "tags", "info [matches ...]"), writing one line of JSON for each.',
+    )
+    notes.add_argument(
+        '--export',
+        type = str,
+        metavar = 'FILE',
+        help = 'Write all notes and their metadata to FILE (or - for stdout), as gzipped lines of JSON.',
+    )
+    notes.add_argument(
+        '--import',
+        type = str,
+        dest = 'import_path',
+        metavar = 'PATH',
+        help = 'Create new notes from an --export file, or from the .txt files in a directory.',
+    )
     notes.add_argument(
         '--list-tags',
         action = 'store_true',
@@ -149,6 +228,17 @@ def main():
         help = 'Check for remote changes every INTERVAL seconds. Defaults to 600 (every 10 minutes), minimum is 30.',
         default = 600,
     )
+    sync.add_argument(
+        '--adaptive',
+        action = 'store_true',
+        help = 'Check for remote changes more often after finding some, and less often while there are none, between --min-fetch-interval and --fetch-interval.',
+    )
+    sync.add_argument(
+        '--min-fetch-interval',
+        type = minimum_interval,
+        help = 'The shortest time between checks for remote changes when using --adaptive. Defaults to 30, which is also the minimum.',
+        default = 30,
+    )
     sync.add_argument(
         '--send-wait',
         type = minimum_wait,
@@ -156,11 +246,46 @@ def main():
         default = 60,
     )
 
+    sync.add_argument(
+        '--prefetch-budget',
+        type = int,
+        help = 'After each check for remote changes, fetch up to BUDGET older versions of recently edited notes, so --history is quick. Defaults to 0 (off).',
+        default = 0,
+    )
+
+    sync.add_argument(
+        '--metrics-file',
+        type = str,
+        help = 'Write metrics about --watch to METRICS_FILE every second, in the Prometheus text format.',
+    )
+    sync.add_argument(
+        '--metrics-port',
+        type = int,
+        help = 'Serve metrics about --watch on http://127.0.0.1:METRICS_PORT/metrics.',
+    )
+
     parser.add_argument(
         '--raw',
         action = 'store_true',
         help = 'Do not Markdownify piped HTML input',
     )
+    parser.add_argument(
+        '--max-size',
+        type = size,
+        help = 'Truncate piped input after SIZE characters (K and M suffixes are allowed).',
+    )
+    parser.add_argument(
+        '--import-rate',
+        type = positive,
+        default = 10,
+        help = 'Create no more than RATE notes a second with --import. Defaults to 10.',
+    )
+    parser.add_argument(
+        '--context',
+        type = int,
+        default = 1,
+        help = 'Show CONTEXT lines around each line found with --grep. Defaults to 1.',
+    )
     parser.add_argument(
         '--full',
         action = 'store_true',
@@ -184,15 +309,51 @@ or the first <h1> tag if the input is detected as HTML.
 
     args = parser.parse_args()
 
+    profiles = load_profiles()
+    if args.profile:
+        if args.profile not in profiles:
+            sys.exit('** No profile "%s" in the config file.' % args.profile)
+        locals = [make_local(profiles[args.profile])]
+    elif args.watch and profiles:
+        # one process, observer and pool of workers for every profile
+        executor = ThreadPoolExecutor(max_workers=8)
+        locals = [make_local(profiles[name], executor) for name in profiles]
+    else:
+        locals = [make_local()]
+    local = locals[0]
+
     try:
         if args.watch:
-            local.watch_for_changes(args.fetch_interval, args.send_wait)
+            min_fetch_interval = None
+            if args.adaptive:
+                min_fetch_interval = min(args.min_fetch_interval, args.fetch_interval)
+            watch = (
+                args.fetch_interval,
+                args.send_wait,
+                min_fetch_interval,
+                args.metrics_file,
+                args.metrics_port,
+                args.prefetch_budget,
+            )
+            if len(locals) > 1:
+                from simplenote_local.watch import Watcher
+                Watcher(locals, *watch).run()
+            else:
+                local.watch_for_changes(*watch)
         elif args.send:
             local.send_changes()
         elif args.fetch:
             local.fetch_changes()
         elif args.list:
             local.list_matching_notes(args.matches)
+        elif args.grep:
+            local.grep_notes(args.grep, args.matches, args.context)
+        elif args.batch:
+            local.answer_queries(sys.stdin)
+        elif args.export:
+            local.export_notes(args.export)
+        elif args.import_path:
+            local.import_notes(args.import_path, args.import_rate)
         elif args.list_tags:
             local.list_tags()
         elif args.add_tag:
@@ -227,7 +388,7 @@ or the first <h1> tag if the input is detected as HTML.
             # --edit is the default, overloaded to also supporting capturing
             # stdin to a named match or new file (taken from the first line)
             if not sys.stdin.isatty():
-                local.capture_stdin(args.raw, args.matches)
+                local.capture_stdin(args.raw, args.matches, args.max_size)
             else:
                 local.edit_matching_notes(args.matches)
 
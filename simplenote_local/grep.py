@@ -0,0 +1,82 @@
+import mmap
+import os
+import re
+
+
+def grep_file(pathname, pattern, context=0):
+    # runs in a worker process, so takes and returns only simple values:
+    # a list of (line number, line, is a matching line) in line order
+    try:
+        with open(pathname, 'rb') as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return search(data, pattern, context)
+    except FileNotFoundError:
+        return []
+
+
+def caseless(pattern):
+    # IGNORECASE on bytes only folds ASCII letters, so any other letter
+    # matches each way it can be written instead (such as é or É)
+    parts = []
+    for character in pattern:
+        if character.isascii():
+            parts.append(re.escape(character.encode('utf-8')))
+            continue
+        forms = sorted({
+            character,
+            character.lower(),
+            character.upper(),
+            character.casefold(),
+        })
+        parts.append(b'(?:' + b'|'.join(
+            re.escape(form.encode('utf-8')) for form in forms
+        ) + b')')
+    return re.compile(b''.join(parts), re.IGNORECASE)
+
+
+def search(data, pattern, context=0):
+    regex = caseless(pattern)
+    size = len(data)
+    lines = {}
+    number = 1
+    position = 0
+    next_line = 0
+
+    for match in regex.finditer(data):
+        if match.start() < next_line:
+            # already found a match on this line
+            continue
+
+        start = data.rfind(b'\n', 0, match.start()) + 1
+        end = data.find(b'\n', match.end())
+        if end == -1:
+            end = size
+        number += data[position:start].count(b'\n')
+        position = start
+        lines[number] = (data[start:end], True)
+        next_line = end + 1
+
+        line_start = start
+        for before in range(1, context + 1):
+            if line_start == 0:
+                break
+            previous = data.rfind(b'\n', 0, line_start - 1) + 1
+            lines.setdefault(number - before, (data[previous:line_start - 1], False))
+            line_start = previous
+
+        line_end = end
+        for after in range(1, context + 1):
+            if line_end >= size - 1:
+                break
+            following = data.find(b'\n', line_end + 1)
+            if following == -1:
+                following = size
+            lines.setdefault(number + after, (data[line_end + 1:following], False))
+            line_end = following
+
+    return [
+        (number, lines[number][0].decode('utf-8', 'replace'), lines[number][1])
+            for number in sorted(lines)
+    ]
@@ -0,0 +1,215 @@
+from array import array
+from bisect import bisect_right
+import mmap
+import os
+import struct
+import sys
+import threading
+
+
+MAGIC = b'SNLI'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+
+
+class WordIndex:
+    """
+    The words in notes, and which notes contain them.
+
+    Stored as a sorted table of terms and packed arrays of file numbers,
+    which is memory mapped and searched where it is, so opening it costs
+    nothing however many words there are. Changes are kept in memory
+    until save() writes a new index.
+
+    It is locked while used, as the map cannot be replaced while another
+    thread (such as one reporting metrics) is reading it.
+
+    Layout after the header (all arrays are native unsigned ints):
+
+        file_starts     file_count + 1 offsets into filenames
+        term_starts     term_count + 1 offsets into terms
+        posting_starts  term_count + 1 offsets into postings
+        postings        file numbers, grouped by term
+        filenames       filenames, each followed by a newline
+        terms           terms in sorted order, each followed by a newline
+    """
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.added = {}
+        self.removed = set()
+        self.merged_count = None
+        self.lock = threading.RLock()
+        self.open()
+
+    def open(self):
+        self.map = None
+        self.file_count = 0
+        self.term_count = 0
+        try:
+            with open(self.pathname, 'rb') as handle:
+                if os.fstat(handle.fileno()).st_size < HEADER.size:
+                    return
+                self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+
+        magic, version, byteorder, self.file_count, self.term_count = (
+            HEADER.unpack_from(self.map, 0)
+        )
+        if magic != MAGIC or version != VERSION or byteorder != self.byteorder():
+            # written by something else, treat as empty and replace it
+            self.map.close()
+            self.map = None
+            self.file_count = 0
+            self.term_count = 0
+            return
+
+        view = memoryview(self.map)
+        offset = HEADER.size
+        self.file_starts, offset = self.ints(view, offset, self.file_count + 1)
+        self.term_starts, offset = self.ints(view, offset, self.term_count + 1)
+        self.posting_starts, offset = self.ints(view, offset, self.term_count + 1)
+        self.postings, offset = self.ints(view, offset, self.posting_starts[-1])
+        self.filenames_start = offset
+        self.terms_start = offset + self.file_starts[-1]
+
+    def ints(self, view, offset, count):
+        end = offset + count * array('I').itemsize
+        return view[offset:end].cast('I'), end
+
+    def byteorder(self):
+        return 1 if sys.byteorder == 'little' else 2
+
+    def __len__(self):
+        # the number of distinct words, which with unsaved changes means
+        # merging them in (only once, until the next change)
+        with self.lock:
+            if not self.added and not self.removed:
+                return self.term_count
+            if self.merged_count is None:
+                self.merged_count = len(self.as_dict())
+            return self.merged_count
+
+    def add(self, filename, words):
+        with self.lock:
+            self.removed.add(filename)
+            self.added[filename] = set(words)
+            self.merged_count = None
+
+    def remove(self, filename):
+        with self.lock:
+            self.removed.add(filename)
+            self.added.pop(filename, None)
+            self.merged_count = None
+
+    def filename(self, number):
+        start = self.filenames_start + self.file_starts[number]
+        end = self.filenames_start + self.file_starts[number + 1] - 1
+        return self.map[start:end].decode('utf-8')
+
+    def term(self, number):
+        start = self.terms_start + self.term_starts[number]
+        end = self.terms_start + self.term_starts[number + 1] - 1
+        return self.map[start:end].decode('utf-8')
+
+    def search(self, fragment):
+        # the filenames containing any word that contains the fragment
+        with self.lock:
+            found = set()
+            needle = fragment.encode('utf-8')
+            if self.map and needle:
+                numbers = set()
+                end = self.terms_start + self.term_starts[-1]
+                position = self.map.find(needle, self.terms_start, end)
+                while position != -1:
+                    term = bisect_right(self.term_starts, position - self.terms_start) - 1
+                    numbers.update(
+                        self.postings[self.posting_starts[term]:self.posting_starts[term + 1]]
+                    )
+                    # carry on from the start of the next term
+                    position = self.map.find(
+                        needle,
+                        self.terms_start + self.term_starts[term + 1],
+                        end,
+                    )
+                for number in numbers:
+                    filename = self.filename(number)
+                    if filename not in self.removed:
+                        found.add(filename)
+
+            for filename, words in self.added.items():
+                for word in words:
+                    if fragment in word:
+                        found.add(filename)
+                        break
+            return found
+
+    def as_dict(self):
+        # every term with the filenames containing it, including changes
+        with self.lock:
+            words = {}
+            for term in range(self.term_count):
+                filenames = set()
+                for number in self.postings[self.posting_starts[term]:self.posting_starts[term + 1]]:
+                    filename = self.filename(number)
+                    if filename not in self.removed:
+                        filenames.add(filename)
+                if filenames:
+                    words[self.term(term)] = filenames
+            for filename, added in self.added.items():
+                for word in added:
+                    words.setdefault(word, set()).add(filename)
+            return words
+
+    def save(self):
+        with self.lock:
+            if not self.added and not self.removed:
+                return
+
+            words = self.as_dict()
+            filenames = sorted(set(
+                filename for word in words for filename in words[word]
+            ))
+            numbers = {filename: number for number, filename in enumerate(filenames)}
+            terms = sorted(words)
+
+            file_starts = array('I', [0])
+            filename_bytes = bytearray()
+            for filename in filenames:
+                filename_bytes += filename.encode('utf-8') + b'\n'
+                file_starts.append(len(filename_bytes))
+
+            term_starts = array('I', [0])
+            posting_starts = array('I', [0])
+            postings = array('I')
+            term_bytes = bytearray()
+            for term in terms:
+                term_bytes += term.encode('utf-8') + b'\n'
+                term_starts.append(len(term_bytes))
+                postings.extend(sorted(numbers[filename] for filename in words[term]))
+                posting_starts.append(len(postings))
+
+            temporary = self.pathname + '.tmp'
+            with open(temporary, 'wb') as handle:
+                handle.write(HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    self.byteorder(),
+                    len(filenames),
+                    len(terms),
+                ))
+                for part in (file_starts, term_starts, posting_starts, postings):
+                    handle.write(part.tobytes())
+                handle.write(filename_bytes)
+                handle.write(term_bytes)
+
+            # views into the old map have to go before it can be closed
+            if self.map:
+                for view in (self.file_starts, self.term_starts, self.posting_starts, self.postings):
+                    view.release()
+                self.map.close()
+            os.replace(temporary, self.pathname)
+            self.added = {}
+            self.removed = set()
+            self.open()
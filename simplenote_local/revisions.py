@@ -0,0 +1,182 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+
+RECORD = struct.Struct('<IIBI')
+NOTE = 0
+MISSING = 1
+
+
+class RevisionStore:
+    """
+    Every version of every note seen, kept locally.
+
+    Each note has a file of records, appended to as versions are seen.
+    A record is the note (as JSON) compressed using the note in the record
+    before it as a preset dictionary, so a version that only changes a few
+    characters of a long note takes a few bytes. Every tenth record is
+    compressed on its own, so reading any version never needs more than
+    ten records decompressed.
+
+    Versions Simplenote no longer has are recorded too, so they are not
+    asked for again.
+
+    Files are locked while being read or appended to, as other processes
+    (such as --history while --watch is running) share them.
+    """
+
+    keyframe_interval = 10
+    # how many notes' records to keep in memory
+    cache_size = 256
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.loaded = {}
+
+    def pathname(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        # version -> (base version, kind, compressed), and the last note
+        # recorded with how many records since it was compressed alone
+        if key in self.loaded:
+            return self.loaded[key]
+
+        records = {}
+        tail = None
+        try:
+            with open(self.pathname(key), 'rb') as handle:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                data = handle.read()
+                offset = self.parse(data, records)
+                if offset < len(data):
+                    # a record cut short by a crash, which would otherwise
+                    # leave everything appended after it unreadable
+                    os.truncate(self.pathname(key), offset)
+        except FileNotFoundError:
+            pass
+
+        for version in records:
+            if records[version][1] == NOTE:
+                if records[version][0] and tail:
+                    tail = (version, tail[1] + 1)
+                else:
+                    tail = (version, 0)
+
+        if len(self.loaded) >= self.cache_size:
+            del self.loaded[next(iter(self.loaded))]
+        self.loaded[key] = (records, tail)
+        return self.loaded[key]
+
+    def parse(self, data, records):
+        # returns where the last complete record ends
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            version, base, kind, length = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            if start + length > len(data):
+                break
+            # a version recorded twice (such as by two processes) keeps
+            # the later record, where it was appended
+            records.pop(version, None)
+            records[version] = (base, kind, data[start:start + length])
+            offset = start + length
+        return offset
+
+    def content(self, records, version):
+        chain = []
+        while version:
+            chain.append(version)
+            version = records[version][0]
+        plain = None
+        for version in reversed(chain):
+            if plain is None:
+                plain = zlib.decompress(records[version][2])
+            else:
+                decompressor = zlib.decompressobj(zdict=plain)
+                plain = decompressor.decompress(records[version][2])
+                plain += decompressor.flush()
+        return plain
+
+    def get(self, key, version):
+        # the note as Simplenote returned it, False if Simplenote no
+        # longer has that version, or None if it has never been seen
+        with self.lock:
+            records, _ = self.load(key)
+            if version not in records:
+                return None
+            if records[version][1] == MISSING:
+                return False
+            try:
+                return json.loads(self.content(records, version))
+            except (KeyError, ValueError, zlib.error):
+                # damaged, so as good as never seen
+                del records[version]
+                return None
+
+    def has(self, key, version):
+        with self.lock:
+            records, _ = self.load(key)
+            return version in records
+
+    def record(self, note):
+        with self.lock:
+            records, tail = self.load(note['key'])
+            existing = records.get(note['version'])
+            if existing and existing[1] == NOTE:
+                return
+
+            plain = json.dumps(note, sort_keys=True).encode('utf-8')
+            previous = None
+            if tail and tail[1] + 1 < self.keyframe_interval:
+                try:
+                    previous = self.content(records, tail[0])
+                except (KeyError, zlib.error):
+                    pass
+            if previous:
+                compressor = zlib.compressobj(9, zdict=previous)
+                compressed = compressor.compress(plain) + compressor.flush()
+                base = tail[0]
+                tail = (note['version'], tail[1] + 1)
+            else:
+                compressed = zlib.compress(plain, 9)
+                base = 0
+                tail = (note['version'], 0)
+
+            self.append(note['key'], note['version'], base, NOTE, compressed)
+            records[note['version']] = (base, NOTE, compressed)
+            self.loaded[note['key']] = (records, tail)
+
+    def record_missing(self, key, version):
+        with self.lock:
+            records, _ = self.load(key)
+            if version in records:
+                return
+            self.append(key, version, 0, MISSING, b'')
+            records[version] = (0, MISSING, b'')
+
+    def append(self, key, version, base, kind, data):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.pathname(key), 'ab') as handle:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            handle.write(RECORD.pack(version, base, kind, len(data)) + data)
+
+    def forget(self, key):
+        with self.lock:
+            self.loaded.pop(key, None)
+            try:
+                os.remove(self.pathname(key))
+            except FileNotFoundError:
+                pass
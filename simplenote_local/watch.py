@@ -0,0 +1,358 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import signal
+import sys
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+
+class Changes(FileSystemEventHandler):
+    # the queue of local files waiting to be sent for one notes directory
+    def __init__(self, local):
+        super().__init__()
+        self.local = local
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.journal_changed = False
+
+        # changes made while not watching
+        for note in self.local.list_changed_notes():
+            pathname = self.local.note_pathname(note.filename)
+            try:
+                when = os.path.getmtime(pathname)
+            except FileNotFoundError:
+                when = 0
+            self.add(note.filename, when)
+            if note.state == 'renamed':
+                # both names have to be sent together to be seen as a
+                # rename, rather than a deletion and a new note
+                self.add(note.previous_filename, when)
+
+    def on_any_event(self, event):
+        # checking a file opens it, which must not count as a change
+        if event.event_type not in ('created', 'modified', 'moved', 'deleted'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if os.path.basename(path) == 'notes.journal':
+                # another simplenote command has queued changes
+                self.journal_changed = True
+            elif path:
+                self.add(os.path.basename(path), time.time())
+
+    def add(self, filename, when):
+        if filename.endswith('.txt') and not filename.startswith('.'):
+            with self.lock:
+                self.pending[filename] = when
+
+    def ready(self, wait):
+        # files that have not changed again for at least wait seconds
+        now = time.time()
+        with self.lock:
+            ready = [
+                filename for filename in self.pending
+                    if self.pending[filename] + wait <= now
+            ]
+            for filename in ready:
+                del self.pending[filename]
+        return ready
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    @property
+    def lag(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+            return time.time() - min(self.pending.values())
+
+
+METRICS = [
+    ('fetches_total', 'counter', 'Fetches from Simplenote.'),
+    ('fetch_errors_total', 'counter', 'Fetches from Simplenote that failed.'),
+    ('fetch_seconds_total', 'counter', 'Time spent fetching from Simplenote.'),
+    ('last_fetch_seconds', 'gauge', 'How long the last fetch took.'),
+    ('sends_total', 'counter', 'Changed notes sent to Simplenote.'),
+    ('send_errors_total', 'counter', 'Changed notes that failed to send.'),
+    ('send_seconds_total', 'counter', 'Time spent sending changed notes.'),
+    ('pending_changes', 'gauge', 'Local changes waiting to be sent.'),
+    ('pending_lag_seconds', 'gauge', 'How long the oldest local change has been waiting.'),
+    ('last_sync_timestamp_seconds', 'gauge', 'When a fetch or send last succeeded.'),
+    ('fetch_interval_seconds', 'gauge', 'Current time between fetches.'),
+    ('notes', 'gauge', 'Notes known.'),
+    ('index_words', 'gauge', 'Words in the search index.'),
+    ('prefetches_total', 'counter', 'Older versions of notes fetched ahead of being asked for.'),
+]
+
+
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as handle:
+            pages = int(handle.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # not Linux, settle for the peak instead
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak
+        return peak * 1024
+
+
+class Watcher:
+    # fetching and sending run in separate threads, so a slow fetch never
+    # holds up local changes going out (and vice versa); they share each
+    # SimplenoteLocal's lock to keep its state consistent
+    def __init__(self, locals, fetch_interval, send_wait, min_fetch_interval=None,
+                 metrics_file=None, metrics_port=None, prefetch_budget=0):
+        self.locals = locals
+        self.prefetch_budget = prefetch_budget
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.fetch_interval = fetch_interval
+        self.min_fetch_interval = min_fetch_interval
+        self.send_wait = send_wait
+        self.changes = {}
+        self.last_fetch = {}
+        self.interval = {}
+        self.fetching = None
+        self.stop = threading.Event()
+
+    def run(self):
+        observer = Observer()
+        for local in self.locals:
+            self.changes[local] = Changes(local)
+            observer.schedule(
+                self.changes[local],
+                path=local.directory,
+                recursive=True,
+            )
+        observer.start()
+
+        lanes = [
+            threading.Thread(target=self.fetch_lane, daemon=True),
+            threading.Thread(target=self.send_lane, daemon=True),
+        ]
+        for lane in lanes:
+            lane.start()
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.show_status())
+
+        server = None
+        if self.metrics_port:
+            server = self.start_metrics_server()
+
+        try:
+            while not self.stop.wait(1):
+                if self.metrics_file:
+                    self.write_metrics_file()
+        except KeyboardInterrupt:
+            self.stop.set()
+        observer.stop()
+        observer.join()
+        for lane in lanes:
+            lane.join()
+        if server:
+            server.shutdown()
+
+    def fetch_lane(self):
+        while not self.stop.is_set():
+            for local in self.locals:
+                last_fetch = self.last_fetch.get(local, 0)
+                interval = self.interval.get(local, self.fetch_interval)
+                if time.time() - last_fetch >= interval:
+                    self.fetch(local)
+                    if self.prefetch_budget:
+                        self.prefetch(local)
+            self.stop.wait(1)
+
+    def fetch(self, local):
+        self.fetching = local
+        changed = 0
+        started = time.time()
+        try:
+            changed = local.fetch_changes()
+            self.count(local, 'last_sync_timestamp_seconds', time.time(), gauge=True)
+        except SystemExit as error:
+            print('** Fetching from Simplenote failed:', error, file=sys.stderr)
+            self.count(local, 'fetch_errors_total')
+        except Exception as error:
+            # anything else must not stop fetching for good
+            print('** Fetching failed: %r' % error, file=sys.stderr)
+            self.count(local, 'fetch_errors_total')
+        self.fetching = None
+        self.last_fetch[local] = time.time()
+        self.count(local, 'fetches_total')
+        self.count(local, 'fetch_seconds_total', self.last_fetch[local] - started)
+        self.count(local, 'last_fetch_seconds', self.last_fetch[local] - started, gauge=True)
+
+        # when adaptive, check again soon after finding changes (someone
+        # is probably still editing), backing off while nothing happens
+        if self.min_fetch_interval:
+            if changed:
+                self.interval[local] = self.min_fetch_interval
+            else:
+                self.interval[local] = min(
+                    self.interval.get(local, self.min_fetch_interval) * 2,
+                    self.fetch_interval,
+                )
+
+    def prefetch(self, local):
+        # uses the time until the next fetch to warm the local history,
+        # without holding the lock sends need
+        try:
+            requests = local.prefetch_note_versions(self.prefetch_budget, self.stop)
+        except SystemExit as error:
+            print('** Prefetching versions failed:', error, file=sys.stderr)
+            return
+        except Exception as error:
+            print('** Prefetching versions failed: %r' % error, file=sys.stderr)
+            return
+        if requests:
+            self.count(local, 'prefetches_total', requests)
+
+    def send_lane(self):
+        while not self.stop.is_set():
+            for local in self.locals:
+                if self.changes[local].journal_changed:
+                    try:
+                        self.queue_journal(local)
+                    except Exception as error:
+                        print('** Reading the journal failed: %r' % error, file=sys.stderr)
+                        self.count(local, 'send_errors_total')
+                filenames = self.changes[local].ready(self.send_wait)
+                if filenames:
+                    self.send(local, filenames)
+            self.stop.wait(1)
+
+    def queue_journal(self, local):
+        self.changes[local].journal_changed = False
+        with local.lock:
+            local.journal = local.load_journal()
+            for entry in local.journal:
+                note = local.notes.get(entry['key'])
+                if note and not note.deleted:
+                    self.changes[local].add(note.filename, 0)
+
+    def send(self, local, filenames):
+        # all files ready together, so a rename is seen as one change
+        started = time.time()
+        try:
+            with local.lock:
+                sent = local.send_file_changes(filenames)
+                if sent:
+                    local.save_data()
+        except SystemExit as error:
+            print('** Sending to Simplenote failed:', error, file=sys.stderr)
+            self.count(local, 'send_errors_total')
+            # try again later
+            for filename in filenames:
+                self.changes[local].add(filename, time.time())
+            return
+        except Exception as error:
+            # such as a file that cannot be read; not retried until it
+            # changes again, but sending carries on for everything else
+            print('** Sending %s failed: %r' % (', '.join(filenames), error), file=sys.stderr)
+            self.count(local, 'send_errors_total')
+            return
+        if sent:
+            self.count(local, 'sends_total', sent)
+            self.count(local, 'send_seconds_total', time.time() - started)
+            self.count(local, 'last_sync_timestamp_seconds', time.time(), gauge=True)
+
+    def count(self, local, name, value=1, gauge=False):
+        with self.counters_lock:
+            if gauge:
+                self.counters[(local, name)] = value
+            else:
+                self.counters[(local, name)] = self.counters.get((local, name), 0) + value
+
+    def metrics(self):
+        # Prometheus text exposition format
+        lines = []
+        for name, kind, help in METRICS:
+            lines.append('# HELP simplenote_local_%s %s' % (name, help))
+            lines.append('# TYPE simplenote_local_%s %s' % (name, kind))
+            for local in self.locals:
+                if name == 'pending_changes':
+                    value = self.changes[local].depth
+                elif name == 'pending_lag_seconds':
+                    value = self.changes[local].lag
+                elif name == 'fetch_interval_seconds':
+                    value = self.interval.get(local, self.fetch_interval)
+                elif name == 'notes':
+                    value = len(local.notes)
+                elif name == 'index_words':
+                    value = len(local.words)
+                else:
+                    with self.counters_lock:
+                        value = self.counters.get((local, name), 0)
+                directory = local.directory.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('simplenote_local_%s{directory="%s"} %s' % (
+                    name,
+                    directory,
+                    round(value, 3),
+                ))
+        lines.append('# HELP simplenote_local_resident_memory_bytes Resident memory used.')
+        lines.append('# TYPE simplenote_local_resident_memory_bytes gauge')
+        lines.append('simplenote_local_resident_memory_bytes %d' % resident_memory())
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics_file(self):
+        # replaced rather than rewritten, so is never read half-written
+        temporary = self.metrics_file + '.tmp'
+        with open(temporary, 'w') as handle:
+            handle.write(self.metrics())
+        os.replace(temporary, self.metrics_file)
+
+    def start_metrics_server(self):
+        watcher = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = watcher.metrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def status(self, local):
+        last_fetch = self.last_fetch.get(local)
+        if last_fetch:
+            last_fetch = datetime.fromtimestamp(last_fetch)
+        return {
+            'pending': self.changes[local].depth,
+            'lag': self.changes[local].lag,
+            'fetching': self.fetching is local,
+            'fetch_interval': self.interval.get(local, self.fetch_interval),
+            'last_fetch': last_fetch,
+        }
+
+    def show_status(self):
+        for local in self.locals:
+            status = self.status(local)
+            print(local.directory)
+            print('  pending   ', status['pending'])
+            print('  lag        %ds' % status['lag'])
+            print('  fetching  ', 'yes' if status['fetching'] else 'no')
+            print('  last fetch', status['last_fetch'] or 'never')
+            print('  interval   %ds' % status['fetch_interval'])